@@ -0,0 +1,223 @@
+"""Headless batch generation.
+
+Usage: python kubebanana.py batch manifest.jsonl [--parallelism N] [--report report.jsonl]
+
+Each manifest line is a JSON object:
+
+    {"id": "sku-123", "prompt": "...", "images": ["in/a.jpg", "s3://catalogue/b.png"],
+     "model": "gemini-3.0-nano-banana-pro", "aspect_ratio": "1:1"}
+
+Only "prompt" and "images" are required. Images are local paths or S3 objects
+("s3://bucket/key", read with the configured S3 credentials). Outputs go through
+the same save modes as the web UI (filesystem > S3); without a filesystem or S3
+target, or --output-dir, the run refuses to start. One JSON status line per
+record is written to the report (stdout by default).
+"""
+import argparse
+import json
+import logging
+import os
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+import gemini
+from imagecache import decode_image, image_digest, sniff_mime_type
+from responsecache import request_digest
+from spool import get_spool
+from storage import (SAVE_FLUSH_TIMEOUT, build_filename, ensure_bucket, make_minio_client, read_object, save_image,
+                     save_writer, upload_stats)
+
+logger = logging.getLogger("kubebanana.batch")
+
+
+def load_storage(output_dir=None):
+    """Resolve the save mode the same way the web UI does: filesystem > S3 > memory."""
+    filesystem_path = output_dir or os.getenv("FILESYSTEM_SAVE_PATH")
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+
+    client = None
+    spool = None
+    bucket_name = os.getenv("S3_BUCKET_NAME")
+    endpoint = os.getenv("S3_ENDPOINT")
+    access_key = os.getenv("S3_ACCESS_KEY")
+    secret_key = os.getenv("S3_SECRET_KEY")
+    if all([endpoint, access_key, secret_key, bucket_name]):
+        secure = os.getenv("S3_SECURE", "true").lower() == "true"
+        # Also used to read s3:// inputs; creating the client makes no request
+        client = make_minio_client(endpoint, access_key, secret_key, secure)
+        if not output_dir:
+            spool = get_spool(client)
+            # The spool creates the bucket before its first upload, and MinIO being down doesn't stop the run
+            if spool is None:
+                ensure_bucket(client, bucket_name)
+
+    if filesystem_path and os.path.isdir(filesystem_path):
+        save_mode = "filesystem"
+    elif client:
+        save_mode = "s3"
+    else:
+        save_mode = "memory"
+    return {"save_mode": save_mode, "filesystem_path": filesystem_path, "client": client, "bucket_name": bucket_name,
+            "spool": spool}
+
+
+def read_manifest(path):
+    records = []
+    with open(path, encoding="utf-8") as f:
+        for line_no, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            record = json.loads(line)
+            record.setdefault("id", str(line_no))
+            records.append(record)
+    return records
+
+
+def load_input(source, storage):
+    if source.startswith("s3://"):
+        if not storage["client"]:
+            raise ValueError(f"S3 input {source} but S3 is not configured")
+        bucket_name, _, object_name = source[len("s3://"):].partition("/")
+        return read_object(storage["client"], bucket_name, object_name)
+    with open(source, "rb") as f:
+        return f.read()
+
+
+def resolve_model(name):
+    if name in gemini.MODEL_MAPPING:
+        return name, gemini.MODEL_MAPPING[name]
+    for choice, api_model_name in gemini.MODEL_MAPPING.items():
+        if api_model_name == name:
+            return choice, api_model_name
+    raise ValueError(f"Unknown model {name!r}; expected one of {', '.join(gemini.MODEL_MAPPING)}")
+
+
+def safe_suffix(record_id):
+    """Record ID as a file name suffix: path separators and other unsafe characters become "_"."""
+    suffix = re.sub(r"[^A-Za-z0-9._-]", "_", str(record_id))
+    # No ".." anywhere, and no leading dot that would hide the file
+    return re.sub(r"\.{2,}", "_", suffix).strip(".") or "_"
+
+
+def run_record(record, storage, date_folder):
+    started = time.monotonic()
+    status = {"id": record["id"], "status": "ok", "images": []}
+    try:
+        if not record.get("prompt", "").strip():
+            raise ValueError("record has no prompt")
+        if not record.get("images"):
+            raise ValueError("record has no input images")
+
+        model_choice, api_model_name = resolve_model(record.get("model") or next(iter(gemini.MODEL_MAPPING)))
+        final_prompt = gemini.build_prompt(record["prompt"], model_choice, record.get("aspect_ratio", "1:1"))
+        contents = [final_prompt]
+        digests = []
+        for source in record["images"]:
+            data = load_input(source, storage)
+            digest = image_digest(data)
+            mime_type = sniff_mime_type(data)
+            img = decode_image(data, digest)
+            # Later records reusing this input can reference the uploaded file
+            gemini.prefetch_input(img, digest, api_model_name, data, mime_type)
+            contents.append(gemini.prepare_input(img, digest, api_model_name, data, mime_type))
+            digests.append(digest)
+        cache_key = request_digest(api_model_name, final_prompt, digests)
+
+        generate_started = time.monotonic()
+        result = gemini.generate(gemini.get_model(api_model_name), contents, cache_key)
+        status["generate_seconds"] = round(time.monotonic() - generate_started, 3)
+        status["cached"] = result.cached
+
+        if not result.images:
+            raise RuntimeError("no image was generated")
+        # Write all image parts concurrently, then report them in order
+        saves = []
+        for index, generated in enumerate(result.images):
+            suffix = safe_suffix(record["id"])
+            if len(result.images) > 1:
+                suffix += f"_{index}"
+            base_name = build_filename(generated.mime_type, date_folder, suffix=suffix, digest=image_digest(generated.data))
+            saves.append((base_name, save_writer.submit(
+                save_image, generated.data, generated.mime_type, base_name, storage["save_mode"],
+                filesystem_path=storage["filesystem_path"],
+                client=storage["client"], bucket_name=storage["bucket_name"], spool=storage["spool"])))
+        for base_name, save in saves:
+            status["images"].append(save.result() or base_name)
+        if result.text:
+            status["text"] = result.text
+    except Exception as e:
+        status["status"] = "error"
+        status["error"] = f"{type(e).__name__}: {e}"
+    status["seconds"] = round(time.monotonic() - started, 3)
+    return status
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="kubebanana batch", description="Run generations from a JSONL manifest.")
+    parser.add_argument("manifest", help="JSONL file with one generation request per line")
+    parser.add_argument("--parallelism", type=int, default=int(os.getenv("BATCH_PARALLELISM", "4")),
+                        help="records processed concurrently (default: 4, or BATCH_PARALLELISM)")
+    parser.add_argument("--report", help="write per-record status lines here instead of stdout")
+    parser.add_argument("--output-dir", help="save outputs to this directory instead of the configured save mode")
+    parser.add_argument("--date-folder", action="store_true", help="save under a date-named folder (YYYY-MM-DD)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    api_key = os.getenv("GEMINI_API_KEY")
+    if not api_key:
+        logger.error("GEMINI_API_KEY environment variable not set.")
+        return 2
+    gemini.configure(api_key)
+
+    records = read_manifest(args.manifest)
+    storage = load_storage(args.output_dir)
+    if storage["save_mode"] == "memory":
+        # Nothing would be written; don't spend quota on outputs that are thrown away
+        logger.error("No output target: set FILESYSTEM_SAVE_PATH or S3 settings, or pass --output-dir.")
+        return 2
+    logger.info("Running %d record(s), parallelism %d, save mode %s",
+                len(records), args.parallelism, storage["save_mode"])
+
+    report = open(args.report, "a", encoding="utf-8") if args.report else sys.stdout
+    failures = 0
+    started = time.monotonic()
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, args.parallelism)) as executor:
+            futures = [executor.submit(run_record, record, storage, args.date_folder) for record in records]
+            for future in as_completed(futures):
+                status = future.result()
+                if status["status"] != "ok":
+                    failures += 1
+                    logger.warning("Record %s failed: %s", status["id"], status["error"])
+                report.write(json.dumps(status) + "\n")
+                report.flush()
+    finally:
+        if report is not sys.stdout:
+            report.close()
+
+    logger.info("Done: %d ok, %d failed in %.1fs", len(records) - failures, failures, time.monotonic() - started)
+    spool = storage["spool"]
+    if spool is not None and spool.pending():
+        logger.info("Waiting up to %.0fs for %d spooled S3 upload(s)", SAVE_FLUSH_TIMEOUT, spool.pending())
+        spool.flush(SAVE_FLUSH_TIMEOUT)
+    if spool is not None and spool.pending():
+        logger.warning("%d S3 upload(s) are still spooled in %s; they are replayed on the next start",
+                       spool.pending(), spool.directory)
+    uploads = upload_stats.summary()
+    if uploads:
+        logger.info("S3: %d upload(s), %.1f MB, median %.1f MB/s, %d multipart",
+                    uploads["uploads"], uploads["bytes"] / 1024 / 1024, uploads["median_mb_per_s"], uploads["multipart"])
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
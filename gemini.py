@@ -0,0 +1,398 @@
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import google.generativeai as genai
+from google.api_core import exceptions as api_exceptions
+from google.generativeai import client as genai_client
+
+from imagecache import downscale_jpeg, image_digest
+from jobs import SingleFlight
+from ratelimit import limiter_for, parse_model_limits
+from retry import call_hedged, call_with_retry, hedge_delay, latencies
+from responsecache import response_cache
+
+# Global cap on concurrent generate_content calls across all sessions
+GEMINI_MAX_INFLIGHT = int(os.getenv("GEMINI_MAX_INFLIGHT", "8"))
+
+# Display name -> API model name
+MODEL_MAPPING = {
+    "gemini-3.0-nano-banana-pro": "gemini-3-pro-image-preview",
+    "gemini-2.5-flash-image-preview": "gemini-2.5-flash-image-preview"
+}
+# Models that take an aspect ratio hint in the prompt
+ASPECT_RATIO_MODELS = {"gemini-3.0-nano-banana-pro"}
+ASPECT_RATIOS = ["1:1", "16:9", "4:3", "3:4", "9:16"]
+
+# Long-edge cap for input images per API model; larger inputs cost upload time and
+# input tokens without improving results. Override with GEMINI_INPUT_LIMITS="model=edge,...".
+MODEL_INPUT_LIMITS = {
+    "gemini-3-pro-image-preview": 3072,
+    "gemini-2.5-flash-image-preview": 1536
+}
+MODEL_INPUT_LIMITS.update({
+    name: int(edge) for name, edge in parse_model_limits(os.getenv("GEMINI_INPUT_LIMITS", "")).items()
+})
+# Fallback long-edge cap for models not listed above, and a pixel-count cap for all; 0 = no limit
+GEMINI_MAX_INPUT_EDGE = int(os.getenv("GEMINI_MAX_INPUT_EDGE", "0"))
+GEMINI_MAX_INPUT_PIXELS = int(os.getenv("GEMINI_MAX_INPUT_PIXELS", "0"))
+
+# Encodings the API accepts as inline data; uploads in these formats are sent as-is
+INLINE_MIME_TYPES = {"image/png", "image/jpeg", "image/webp", "image/heic", "image/heif"}
+
+# --- Speculative Files API uploads (opt-in) ---
+GEMINI_PREUPLOAD = os.getenv("GEMINI_PREUPLOAD", "false").lower() == "true"
+# Uploaded files expire after 48 hours; stop referencing them a little earlier
+GEMINI_FILE_TTL = int(os.getenv("GEMINI_FILE_TTL", str(47 * 3600)))
+GEMINI_PREUPLOAD_WORKERS = int(os.getenv("GEMINI_PREUPLOAD_WORKERS", "4"))
+# Exchanges (prompt + result) an edit session keeps and resends by reference
+GEMINI_EDIT_MAX_TURNS = max(1, int(os.getenv("GEMINI_EDIT_MAX_TURNS", "4")))
+
+GeneratedImage = namedtuple("GeneratedImage", ["data", "mime_type"])
+# content is the model's response content as returned (None for cached results), kept for edit history
+GenerationResult = namedtuple("GenerationResult", ["images", "text", "cached", "content"], defaults=[False, None])
+# part is the original response part for model images, so its other fields survive the swap to a file reference
+HistoryImage = namedtuple("HistoryImage", ["key", "blob", "part"], defaults=[None])
+
+
+
+class GenerationProgress:
+    """Output of a streaming generation so far; written by the worker thread, read by the UI.
+
+    on_image(index, image), when given, is called on the worker thread as each image arrives.
+    """
+
+    def __init__(self, on_image=None):
+        self._lock = threading.Lock()
+        self.on_image = on_image
+        self.text = ""
+        self.images = []
+
+    def reset(self):
+        with self._lock:
+            self.text = ""
+            self.images = []
+
+    def add_text(self, text):
+        with self._lock:
+            self.text += text
+
+    def add_image(self, image):
+        with self._lock:
+            self.images.append(image)
+            index = len(self.images) - 1
+        if self.on_image is not None:
+            self.on_image(index, image)
+
+    def snapshot(self):
+        with self._lock:
+            return self.text, list(self.images)
+
+
+class StreamInterrupted(Exception):
+    """A stream failed after images were already handed out, so it is not retried."""
+
+
+class FilePrefetcher:
+    """Uploads request parts in the background so later requests can reference the file instead.
+
+    upload_fn(file_obj, mime_type=...) returns a handle usable in request
+    contents; genai.upload_file by default, or any stand-in with that signature.
+    """
+
+    def __init__(self, upload_fn, ttl, workers, max_entries=256):
+        self.upload_fn = upload_fn
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="preupload")
+        self._uploads = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _usable(self, entry):
+        future, started = entry
+        if time.monotonic() - started > self.ttl:
+            return False
+        return not (future.done() and future.exception() is not None)
+
+    def prefetch(self, key, make_part):
+        """Upload make_part()'s bytes under key unless a live or pending upload already exists."""
+        with self._lock:
+            entry = self._uploads.get(key)
+            if entry is not None and self._usable(entry):
+                self._uploads.move_to_end(key)
+                return
+            self._uploads[key] = (self._pool.submit(self._upload, make_part), time.monotonic())
+            while len(self._uploads) > self.max_entries:
+                self._uploads.popitem(last=False)
+
+    def _upload(self, make_part):
+        part = make_part()
+        if not isinstance(part, dict):
+            return None
+        return self.upload_fn(BytesIO(part["data"]), mime_type=part["mime_type"])
+
+    def get(self, key):
+        """The uploaded file handle if it is ready; never waits for a pending upload."""
+        with self._lock:
+            entry = self._uploads.get(key)
+        if entry is None or not self._usable(entry) or not entry[0].done():
+            return None
+        handle = entry[0].result()
+        state = getattr(getattr(handle, "state", None), "name", "ACTIVE")
+        return handle if state == "ACTIVE" else None
+
+
+# Used for speculative input uploads (GEMINI_PREUPLOAD) and for edit-session history
+file_prefetcher = FilePrefetcher(genai.upload_file, GEMINI_FILE_TTL, GEMINI_PREUPLOAD_WORKERS)
+
+
+class EditSession:
+    """Multi-turn edit conversation on one model with a fixed set of input images.
+
+    Follow-up prompts are sent as a new turn after the earlier ones, so the
+    model works from its previous image. Images recorded into the history are
+    uploaded to the Files API in the background, and later turns reference
+    them by handle instead of resending their bytes. The first exchange,
+    which carries the input images, is always kept; of the follow-ups only
+    the last max_turns are.
+    """
+
+    def __init__(self, model_name, input_digests, max_turns):
+        self.model_name = model_name
+        self.input_digests = tuple(input_digests)
+        self.max_turns = max(1, max_turns)
+        self.turns = []
+
+    def matches(self, model_name, input_digests):
+        return self.model_name == model_name and self.input_digests == tuple(input_digests)
+
+    def contents(self, user_turn):
+        """Request contents for a new user turn: the kept history followed by the turn."""
+        contents = []
+        for turn in self.turns:
+            for content in turn:
+                contents.append({"role": content["role"], "parts": [_resolve_history_part(p) for p in content["parts"]]})
+        contents.append(user_turn)
+        return contents
+
+    def record(self, user_turn, result):
+        if result.content is not None:
+            # Send the model turn back as returned: every part, with fields like thought signatures intact
+            model_parts = list(result.content.parts)
+        else:
+            # Cached results only have the parsed output
+            model_parts = []
+            if result.text:
+                model_parts.append(result.text)
+            for image in result.images:
+                model_parts.append({"mime_type": image.mime_type, "data": image.data})
+        user_content = {"role": "user", "parts": [_history_part(p) for p in user_turn["parts"]]}
+        model_content = {"role": "model", "parts": [_history_part(p) for p in model_parts]}
+        self.turns.append((user_content, model_content))
+        del self.turns[1:-self.max_turns]
+
+    def reset(self):
+        self.turns = []
+
+
+def _history_part(part):
+    # Inline images are swapped for a Files API reference once the background upload finishes
+    if isinstance(part, dict):
+        key = ("history", image_digest(part["data"]))
+        file_prefetcher.prefetch(key, lambda: part)
+        return HistoryImage(key, part)
+    inline_data = getattr(part, "inline_data", None)
+    if inline_data:
+        blob = {"mime_type": inline_data.mime_type or "image/png", "data": inline_data.data}
+        key = ("history", image_digest(blob["data"]))
+        file_prefetcher.prefetch(key, lambda: blob)
+        return HistoryImage(key, blob, part)
+    return part
+
+
+def _resolve_history_part(part):
+    if not isinstance(part, HistoryImage):
+        return part
+    handle = file_prefetcher.get(part.key)
+    if part.part is None:
+        return handle or part.blob
+    if handle is None:
+        return part.part
+    # A copy of the response part with only its image data replaced by the file reference
+    resolved = type(part.part)(part.part)
+    resolved.file_data = {"mime_type": part.blob["mime_type"], "file_uri": handle.uri}
+    return resolved
+
+
+def is_history_rejected(error):
+    """True when a follow-up failed because the API refused the request itself (e.g. the edit history)."""
+    return isinstance(error, api_exceptions.InvalidArgument)
+
+
+# Process-wide registry: the SDK keeps one pooled transport per configuration,
+# so configuring again would throw the warm connections away.
+_lock = threading.Lock()
+_configured_key = None
+_models = {}
+_inflight = threading.BoundedSemaphore(GEMINI_MAX_INFLIGHT)
+_singleflight = SingleFlight()
+
+
+def configure(api_key):
+    global _configured_key
+    with _lock:
+        if _configured_key == api_key:
+            return
+        genai.configure(api_key=api_key)
+        # Build the shared transport now rather than on the first generate call
+        genai_client.get_default_generative_client()
+        _models.clear()
+        _configured_key = api_key
+
+
+def get_model(model_name):
+    """Return the cached GenerativeModel handle for an API model name."""
+    with _lock:
+        model = _models.get(model_name)
+        if model is None:
+            model = genai.GenerativeModel(model_name)
+            _models[model_name] = model
+        return model
+
+
+def build_prompt(prompt, model_choice, image_ratio=None):
+    """Incorporate model-specific settings into the prompt."""
+    final_prompt = prompt.strip()
+    if model_choice in ASPECT_RATIO_MODELS and image_ratio:
+        final_prompt += f"\n\nSpecifications:\n- Aspect Ratio: {image_ratio}"
+    return final_prompt
+
+
+def _input_key(digest, model_name):
+    # Models with the same input limits send identical bytes and can share an upload
+    return digest, MODEL_INPUT_LIMITS.get(model_name, GEMINI_MAX_INPUT_EDGE), GEMINI_MAX_INPUT_PIXELS
+
+
+def prefetch_input(img, digest, model_name, data=None, mime_type=None):
+    """Start uploading an input to the Files API ahead of Generate (no-op unless GEMINI_PREUPLOAD)."""
+    if GEMINI_PREUPLOAD:
+        file_prefetcher.prefetch(
+            _input_key(digest, model_name),
+            lambda: _inline_input(img, digest, model_name, data, mime_type)
+        )
+
+
+def prepare_input(img, digest, model_name, data=None, mime_type=None):
+    """Request part for an input image, downscaled to the model's useful resolution.
+
+    An input already pre-uploaded to the Files API is referenced by its file
+    handle. Otherwise the original encoded bytes are sent untouched whenever no
+    downscale is needed and their format is accepted; only a downscaled image
+    is re-encoded.
+    """
+    handle = file_prefetcher.get(_input_key(digest, model_name))
+    if handle is not None:
+        return handle
+    return _inline_input(img, digest, model_name, data, mime_type)
+
+
+def _inline_input(img, digest, model_name, data, mime_type):
+    max_edge = MODEL_INPUT_LIMITS.get(model_name, GEMINI_MAX_INPUT_EDGE)
+    scaled = downscale_jpeg(img, digest, max_edge, GEMINI_MAX_INPUT_PIXELS)
+    if scaled is not None:
+        return {"mime_type": "image/jpeg", "data": scaled}
+    if data is not None and mime_type in INLINE_MIME_TYPES:
+        return {"mime_type": mime_type, "data": data}
+    # Unknown format: let the SDK encode the decoded image
+    return img
+
+
+def parse_response(response):
+    images = []
+    texts = []
+    for part in response.parts:
+        if hasattr(part, "text") and part.text:
+            texts.append(part.text)
+        elif hasattr(part, "inline_data") and part.inline_data:
+            images.append(GeneratedImage(part.inline_data.data, part.inline_data.mime_type or "image/png"))
+    content = response.candidates[0].content if response.candidates else None
+    return GenerationResult(images, "".join(texts) or None, content=content)
+
+
+def generate(model, contents, cache_key=None, progress=None):
+    """Run one generation; blocks while GEMINI_MAX_INFLIGHT calls are already running.
+
+    With a cache_key (see responsecache.request_digest), identical requests
+    already in flight are coalesced onto one API call, and when the response
+    cache is enabled a stored result is returned without calling the API.
+    With a GenerationProgress the response is streamed into it as it arrives.
+    """
+    if cache_key is None:
+        return _generate(model, contents, None, progress)
+    result, shared = _singleflight.do(cache_key, _generate, model, contents, cache_key, progress)
+    return result._replace(cached=True) if shared else result
+
+
+def _generate(model, contents, cache_key, progress):
+    use_cache = cache_key is not None and response_cache is not None
+    if use_cache:
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            images, text = cached
+            return GenerationResult([GeneratedImage(*image) for image in images], text, cached=True)
+
+    if progress is not None:
+        result = call_with_retry(lambda: _stream_model(model, contents, progress))
+    else:
+        response = call_with_retry(lambda: call_hedged(
+            lambda sent: _call_model(model, contents, sent), hedge_delay(model.model_name)
+        ))
+        result = parse_response(response)
+
+    if use_cache and result.images:
+        response_cache.put(cache_key, result.images, result.text)
+    return result
+
+
+def _call_model(model, contents, sent=None):
+    # Per-model quota limiter first, so calls waiting for tokens don't hold a global slot
+    with limiter_for(model.model_name).slot(), _inflight:
+        if sent is not None:
+            # The hedge delay starts now, not while this call was queued for quota
+            sent.set()
+        started = time.monotonic()
+        response = model.generate_content(contents, stream=False)
+        latencies.record(model.model_name, time.monotonic() - started)
+    return response
+
+
+def _stream_model(model, contents, progress):
+    progress.reset()
+    # Every streamed part, in order, so edit sessions can send the model turn back as returned
+    parts = []
+    content_type = None
+    try:
+        with limiter_for(model.model_name).slot(), _inflight:
+            for chunk in model.generate_content(contents, stream=True):
+                if not chunk.candidates:
+                    continue
+                content_type = type(chunk.candidates[0].content)
+                for part in chunk.candidates[0].content.parts:
+                    parts.append(part)
+                    if hasattr(part, "text") and part.text:
+                        progress.add_text(part.text)
+                    elif hasattr(part, "inline_data") and part.inline_data:
+                        progress.add_image(
+                            GeneratedImage(part.inline_data.data, part.inline_data.mime_type or "image/png")
+                        )
+    except Exception as e:
+        # Images may already be shown or saving; a retry would produce a second, different set
+        if progress.images:
+            raise StreamInterrupted(f"stream failed after {len(progress.images)} image(s): {e}") from e
+        raise
+    text, images = progress.snapshot()
+    content = content_type(role="model", parts=parts) if content_type is not None else None
+    return GenerationResult(images, text or None, content=content)
@@ -0,0 +1,156 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from io import BytesIO
+
+from PIL import Image
+
+# --- Cache limits ---
+DECODE_CACHE_MAX_ENTRIES = int(os.getenv("DECODE_CACHE_MAX_ENTRIES", "32"))
+DECODE_CACHE_MAX_MB = int(os.getenv("DECODE_CACHE_MAX_MB", "512"))
+THUMB_CACHE_MAX_ENTRIES = int(os.getenv("THUMB_CACHE_MAX_ENTRIES", "256"))
+THUMB_CACHE_MAX_MB = int(os.getenv("THUMB_CACHE_MAX_MB", "128"))
+DOWNSCALE_CACHE_MAX_ENTRIES = int(os.getenv("DOWNSCALE_CACHE_MAX_ENTRIES", "32"))
+DOWNSCALE_CACHE_MAX_MB = int(os.getenv("DOWNSCALE_CACHE_MAX_MB", "256"))
+
+
+class LRUCache:
+    """Thread-safe LRU cache bounded by entry count and total size in bytes."""
+
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value, size):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.total_bytes -= old[1]
+            # Values larger than the whole budget are returned but never retained
+            if size > self.max_bytes:
+                return value
+            self._entries[key] = (value, size)
+            self.total_bytes += size
+            while len(self._entries) > self.max_entries or self.total_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+            return value
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            self.total_bytes -= entry[1]
+            return entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.total_bytes = 0
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+
+def image_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def image_nbytes(img):
+    return img.width * img.height * len(img.getbands())
+
+
+_decoded = LRUCache(DECODE_CACHE_MAX_ENTRIES, DECODE_CACHE_MAX_MB * 1024 * 1024)
+_thumbnails = LRUCache(THUMB_CACHE_MAX_ENTRIES, THUMB_CACHE_MAX_MB * 1024 * 1024)
+_downscaled = LRUCache(DOWNSCALE_CACHE_MAX_ENTRIES, DOWNSCALE_CACHE_MAX_MB * 1024 * 1024)
+
+
+def decode_image(data, digest=None):
+    """Decode encoded image bytes to RGB, reusing earlier decodes of the same content."""
+    digest = digest or image_digest(data)
+    img = _decoded.get(digest)
+    if img is None:
+        img = Image.open(BytesIO(data)).convert("RGB")
+        _decoded.put(digest, img, image_nbytes(img))
+    return img
+
+
+def get_thumbnail(img, digest, size):
+    """Return a LANCZOS thumbnail fitting in size x size, cached per (digest, size)."""
+    key = (digest, size)
+    thumb = _thumbnails.get(key)
+    if thumb is None:
+        scale = min(size / img.width, size / img.height)
+        if scale >= 1:
+            # Like Image.thumbnail, never upscale; the image itself is the thumbnail
+            return img
+        thumb_size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+        thumb = img.resize(thumb_size, Image.Resampling.LANCZOS)
+        _thumbnails.put(key, thumb, image_nbytes(thumb))
+    return thumb
+
+
+def thumbnail_from_bytes(data, digest, size):
+    """Thumbnail made straight from encoded bytes; the full-size decode is dropped afterwards, not cached."""
+    thumb = _thumbnails.get((digest, size))
+    if thumb is None:
+        img = Image.open(BytesIO(data))
+        # JPEG decodes at a reduced scale that still covers the thumbnail; a no-op for other formats
+        img.draft("RGB", (size, size))
+        thumb = get_thumbnail(img.convert("RGB"), digest, size)
+    return thumb
+
+
+def sniff_mime_type(data):
+    """Mime type from the image header (only the header is parsed), or None if unknown."""
+    try:
+        mime_type = Image.open(BytesIO(data)).get_format_mimetype()
+    except Exception:
+        return None
+    # Pillow reports multi-picture JPEGs (many phone cameras) as MPO; the stream is a valid JPEG
+    return "image/jpeg" if mime_type == "image/mpo" else mime_type
+
+
+def downscale_jpeg(img, digest, max_edge=0, max_pixels=0, quality=90):
+    """JPEG bytes of img shrunk so its long edge and pixel count fit the limits (0 = no limit).
+
+    Returns None when the image already fits, so callers can send the original
+    bytes. Results are cached per (digest, limits); the resize goes through
+    reducing_gap, which is much faster than a plain resampling pass on large photos.
+    """
+    scale = 1.0
+    if max_edge:
+        scale = min(scale, max_edge / max(img.width, img.height))
+    if max_pixels:
+        scale = min(scale, (max_pixels / (img.width * img.height)) ** 0.5)
+    if scale >= 1:
+        return None
+
+    key = (digest, max_edge, max_pixels, quality)
+    data = _downscaled.get(key)
+    if data is None:
+        size = (max(1, int(img.width * scale)), max(1, int(img.height * scale)))
+        scaled = img.resize(size, Image.Resampling.BICUBIC, reducing_gap=2.0)
+        out = BytesIO()
+        scaled.save(out, format="JPEG", quality=quality)
+        data = out.getvalue()
+        _downscaled.put(key, data, len(data))
+    return data
@@ -0,0 +1,107 @@
+import itertools
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# --- Worker pool limits ---
+GENERATION_WORKERS = int(os.getenv("GENERATION_WORKERS", "8"))
+GENERATION_QUEUE_LIMIT = int(os.getenv("GENERATION_QUEUE_LIMIT", "64"))
+# Finished jobs nobody collected (closed tabs, restarts) are dropped after this long
+JOB_RETENTION_SECONDS = int(os.getenv("JOB_RETENTION_SECONDS", "900"))
+
+
+class QueueFull(Exception):
+    pass
+
+
+class JobQueue:
+    """Process-wide pool running jobs off the Streamlit script thread, addressed by job ID."""
+
+    def __init__(self, workers, queue_limit, retention_seconds):
+        self.queue_limit = queue_limit
+        self.retention_seconds = retention_seconds
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="generation")
+        self._jobs = {}
+        self._finished_at = {}
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        with self._lock:
+            self._prune()
+            if self.pending() >= self.queue_limit:
+                raise QueueFull(f"{self.queue_limit} jobs already waiting")
+            job_id = uuid.uuid4().hex
+            future = self._executor.submit(fn, *args, **kwargs)
+            future.sequence = next(self._sequence)
+            future.add_done_callback(lambda _: self._finished_at.__setitem__(job_id, time.monotonic()))
+            self._jobs[job_id] = future
+            return job_id
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def discard(self, job_id):
+        with self._lock:
+            self._jobs.pop(job_id, None)
+            self._finished_at.pop(job_id, None)
+
+    def pending(self):
+        return sum(1 for future in list(self._jobs.values()) if not future.done())
+
+    def position(self, job_id):
+        """Number of unfinished jobs submitted before this one."""
+        future = self._jobs.get(job_id)
+        if future is None:
+            return 0
+        return sum(
+            1 for other in list(self._jobs.values())
+            if not other.done() and other.sequence < future.sequence
+        )
+
+    def _prune(self):
+        cutoff = time.monotonic() - self.retention_seconds
+        for job_id, finished in list(self._finished_at.items()):
+            if finished < cutoff:
+                self._jobs.pop(job_id, None)
+                self._finished_at.pop(job_id, None)
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key: one leader runs, followers wait for its result."""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, *args, **kwargs):
+        """Return (result, shared); shared is True when another caller's execution was reused."""
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._calls[key] = future
+        if not leader:
+            return future.result(), True
+
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+
+    def inflight(self):
+        with self._lock:
+            return len(self._calls)
+
+
+generation_jobs = JobQueue(GENERATION_WORKERS, GENERATION_QUEUE_LIMIT, JOB_RETENTION_SECONDS)
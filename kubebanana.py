@@ -1,15 +1,26 @@
 import streamlit as st
-import google.generativeai as genai
-from PIL import Image
-from io import BytesIO
-from minio import Minio
-from datetime import datetime
 import os
+import sys
+import time
 from dotenv import load_dotenv
 
-# Load environment variables
+# Load environment variables (before the local modules read their settings)
 load_dotenv()
 
+import gemini
+from imagecache import decode_image, get_thumbnail, image_digest, sniff_mime_type, thumbnail_from_bytes
+from jobs import QueueFull, generation_jobs
+from responsecache import request_digest
+from spool import get_spool
+from storage import (S3_PRESIGNED_URLS, build_filename, ensure_bucket, make_minio_client, make_presign_client,
+                     presigned_url, save_image, save_writer, upload_stats)
+
+# --- Headless batch mode: python kubebanana.py batch manifest.jsonl ---
+# `streamlit run` passes no extra arguments, so this never triggers for the web UI.
+if __name__ == "__main__" and sys.argv[1:2] == ["batch"]:
+    import batch
+    sys.exit(batch.main(sys.argv[2:]))
+
 # --- Page setup ---
 st.set_page_config(page_title="🎨🍌 Gemini nano-banana Multi-Image Editor", layout="wide")
 st.title("🎨🍌 Gemini nano-banana Multi-Image Editor")
@@ -28,22 +39,45 @@ S3_SECRET_KEY = os.getenv("S3_SECRET_KEY")
 S3_BUCKET_NAME = os.getenv("S3_BUCKET_NAME")
 S3_SECURE = os.getenv("S3_SECURE", "true").lower() == "true"
 
+
+@st.cache_resource(show_spinner=False)
+def get_minio_client(endpoint, access_key, secret_key, secure):
+    # One client and connection pool per process, shared with the S3 spool
+    return make_minio_client(endpoint, access_key, secret_key, secure)
+
+
+@st.cache_resource(show_spinner=False)
+def bootstrap_bucket(_client, bucket_name):
+    # Runs once per process; failures are not cached and retry on the next run
+    ensure_bucket(_client, bucket_name)
+    return True
+
+
 s3_configured = all([S3_ENDPOINT, S3_ACCESS_KEY, S3_SECRET_KEY, S3_BUCKET_NAME])
 minio_client = None
+s3_spool = None
 if s3_configured:
-    try:
-        minio_client = Minio(
-            S3_ENDPOINT,
-            access_key=S3_ACCESS_KEY,
-            secret_key=S3_SECRET_KEY,
-            secure=S3_SECURE
-        )
-        if not minio_client.bucket_exists(S3_BUCKET_NAME):
-            minio_client.make_bucket(S3_BUCKET_NAME)
-    except Exception as e:
-        st.error(f"❌ MinIO init error: {e}")
-        minio_client = None
-        s3_configured = False
+    minio_client = get_minio_client(S3_ENDPOINT, S3_ACCESS_KEY, S3_SECRET_KEY, S3_SECURE)
+    s3_spool = get_spool(minio_client)
+    # The spool creates the bucket before its first upload, and MinIO being down doesn't block it
+    if s3_spool is None:
+        try:
+            bootstrap_bucket(minio_client, S3_BUCKET_NAME)
+        except Exception as e:
+            st.error(f"❌ MinIO init error: {e}")
+            minio_client = None
+            s3_configured = False
+
+
+@st.cache_resource(show_spinner=False)
+def get_presign_client(endpoint, access_key, secret_key, secure):
+    return make_presign_client(endpoint, access_key, secret_key, secure)
+
+
+# Serve stored outputs to the browser straight from MinIO instead of through this process
+presign_client = None
+if minio_client and S3_PRESIGNED_URLS:
+    presign_client = get_presign_client(S3_ENDPOINT, S3_ACCESS_KEY, S3_SECRET_KEY, S3_SECURE)
 
 # --- Filesystem save configuration ---
 FILESYSTEM_SAVE_PATH = os.getenv("FILESYSTEM_SAVE_PATH")
@@ -58,8 +92,16 @@ else:
     save_mode = "memory"
 
 # --- Gemini configuration ---
+# How often a pending generation job is polled, in seconds
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "1.0"))
+# Candidate fan-out: upper bound for the sidebar setting and the shared deadline in seconds
+MAX_CANDIDATES = int(os.getenv("MAX_CANDIDATES", "4"))
+CANDIDATE_DEADLINE = float(os.getenv("CANDIDATE_DEADLINE", "180"))
+# Default for the "Stream results as they arrive" sidebar option
+GEMINI_STREAM = os.getenv("GEMINI_STREAM", "false").lower() == "true"
+
 try:
-    genai.configure(api_key=api_key)
+    gemini.configure(api_key)
 except Exception as e:
     st.error(f"❌ Gemini setup error: {e}")
     st.stop()
@@ -81,31 +123,50 @@ else:
 st.sidebar.subheader("Model")
 model_choice = st.sidebar.selectbox(
     "Select Model",
-    ["gemini-3.0-nano-banana-pro", "gemini-2.5-flash-image-preview"],
+    list(gemini.MODEL_MAPPING),
     index=0
 )
 
-if model_choice == "gemini-3.0-nano-banana-pro":
+image_ratio = None
+if model_choice in gemini.ASPECT_RATIO_MODELS:
     image_ratio = st.sidebar.selectbox(
         "Image Ratio",
-        ["1:1", "16:9", "4:3", "3:4", "9:16"],
+        gemini.ASPECT_RATIOS,
         index=0
     )
 
 thumb_size = st.sidebar.slider("Thumbnail size (pixels)", min_value=100, max_value=600, value=300, step=50)
 save_with_date_folder = st.sidebar.checkbox("Save under date-named folder (YYYY-MM-DD)", value=False)
+stream_results = st.sidebar.checkbox(
+    "Stream results as they arrive",
+    value=GEMINI_STREAM,
+    help="Show the response text and image as soon as each part arrives, and start saving right away"
+)
+num_candidates = 1
+if MAX_CANDIDATES > 1:
+    num_candidates = st.sidebar.slider(
+        "Candidates per generation", min_value=1, max_value=MAX_CANDIDATES, value=1,
+        help="Run several generations of the same request in parallel and keep the one you pick"
+    )
+edit_mode = st.sidebar.checkbox(
+    "Edit session (follow-ups refine the last result)",
+    value=False,
+    help="Each Generate continues the conversation with the model instead of starting over, "
+         "so refinements send only the new prompt"
+)
+edit_session = st.session_state.get("edit_session")
+if edit_mode and edit_session and edit_session.turns:
+    st.sidebar.caption(f"🧵 {len(edit_session.turns)} turn(s) in this edit session")
+    if st.sidebar.button("🔄 Reset edit session"):
+        st.session_state.edit_session = None
+        st.rerun()
 
 st.sidebar.markdown("---")
 
 # --- Model Instantiation ---
-model_mapping = {
-    "gemini-2.5-flash-image-preview": "gemini-2.5-flash-image-preview",
-    "gemini-3.0-nano-banana-pro": "gemini-3-pro-image-preview"
-}
-
 try:
-    api_model_name = model_mapping[model_choice]
-    model = genai.GenerativeModel(api_model_name)
+    api_model_name = gemini.MODEL_MAPPING[model_choice]
+    model = gemini.get_model(api_model_name)
 except Exception as e:
     st.error(f"❌ Model initialization error: {e}")
     st.stop()
@@ -124,12 +185,24 @@ st.divider()
 # --- Session state initialization ---
 if 'uploaded_images' not in st.session_state:
     st.session_state.uploaded_images = {}
-if 'generated_image' not in st.session_state:
-    st.session_state.generated_image = None
-if 'generated_image_bytes' not in st.session_state:
-    st.session_state.generated_image_bytes = None
-if 'current_filename' not in st.session_state:
-    st.session_state.current_filename = None
+if 'uploaded_digests' not in st.session_state:
+    st.session_state.uploaded_digests = {}
+if 'uploaded_sources' not in st.session_state:
+    st.session_state.uploaded_sources = {}
+# One entry per image part of the last response: thumbnail, encoded bytes, mime type, digest, filename, save
+if 'generated_images' not in st.session_state:
+    st.session_state.generated_images = []
+if 'generation_job' not in st.session_state:
+    st.session_state.generation_job = None
+# Background saves of the last result, reported when they complete
+if 'pending_saves' not in st.session_state:
+    st.session_state.pending_saves = None
+# Slots filled from a generated image rather than an upload
+if 'generated_slots' not in st.session_state:
+    st.session_state.generated_slots = set()
+# Bumping a slot's version gives its uploader a new key, which clears it
+if 'uploader_versions' not in st.session_state:
+    st.session_state.uploader_versions = {f'img{i}': 0 for i in range(1, 5)}
 
 # --- Image upload UI ---
 st.subheader("📤 Upload Your Images")
@@ -140,24 +213,98 @@ for i, col in enumerate(cols, start=1):
     with col:
         label = f"Image {i}" + (" *Required" if i == 1 else " (Optional)")
         st.markdown(f"**{label}**", unsafe_allow_html=True)
-        uploader = st.file_uploader(f"img{i}", type=["png", "jpg", "jpeg"], key=f"img{i}", label_visibility="collapsed")
+        uploader_key = f"img{i}_{st.session_state.uploader_versions[f'img{i}']}"
+        uploader = st.file_uploader(f"img{i}", type=["png", "jpg", "jpeg"], key=uploader_key, label_visibility="collapsed")
         if uploader:
-            img_bytes = uploader.read()
-            img = Image.open(BytesIO(img_bytes)).convert("RGB")
+            st.session_state.generated_slots.discard(f'img{i}')
+            img_bytes = uploader.getvalue()
+            digest = image_digest(img_bytes)
+            img = decode_image(img_bytes, digest)
             st.session_state.uploaded_images[f'img{i}'] = img
-            uploader.seek(0)
-            thumb = img.copy()
-            thumb.thumbnail((thumb_size, thumb_size), Image.Resampling.LANCZOS)
+            st.session_state.uploaded_digests[f'img{i}'] = digest
+            # Original encoded bytes and mime type, sent as-is when no downscale is needed
+            st.session_state.uploaded_sources[f'img{i}'] = (img_bytes, sniff_mime_type(img_bytes))
+            gemini.prefetch_input(img, digest, api_model_name, *st.session_state.uploaded_sources[f'img{i}'])
+            thumb = get_thumbnail(img, digest, thumb_size)
             with st.container():
                 st.image(thumb)
                 st.success("✓ Ready", icon="🎉")
+        elif f'img{i}' in st.session_state.generated_slots:
+            # Already decoded and hashed when it was generated, so the caches hit
+            gemini.prefetch_input(
+                st.session_state.uploaded_images[f'img{i}'],
+                st.session_state.uploaded_digests[f'img{i}'],
+                api_model_name,
+                *st.session_state.uploaded_sources[f'img{i}']
+            )
+            st.image(get_thumbnail(
+                st.session_state.uploaded_images[f'img{i}'],
+                st.session_state.uploaded_digests[f'img{i}'],
+                thumb_size
+            ))
+            st.info("✓ From generated image", icon="♻️")
+            if st.button("✖ Clear", key=f"clear_generated_img{i}"):
+                st.session_state.generated_slots.discard(f'img{i}')
+                st.rerun()
         else:
             st.session_state.uploaded_images.pop(f'img{i}', None)
+            st.session_state.uploaded_digests.pop(f'img{i}', None)
+            st.session_state.uploaded_sources.pop(f'img{i}', None)
 
 st.divider()
 
+
+def collect_results(job):
+    """Move finished candidates from the job queue into job["results"] (a result or an exception)."""
+    for index, job_id in enumerate(job["ids"]):
+        if index in job["results"]:
+            continue
+        future = generation_jobs.get(job_id)
+        if future is None:
+            job["results"][index] = RuntimeError("The generation job was lost. Please try again.")
+        elif future.done():
+            generation_jobs.discard(job_id)
+            try:
+                job["results"][index] = future.result()
+            except Exception as e:
+                job["results"][index] = e
+
+
+def start_save(generated, index=0):
+    """Start persisting a generated image in the background; returns (base_name, future or None)."""
+    # Later image parts of the same response get a part number so they don't overwrite the first
+    base_name = build_filename(generated.mime_type, save_with_date_folder, suffix=str(index + 1) if index else None,
+                               digest=image_digest(generated.data))
+    if save_mode == "filesystem":
+        return base_name, save_writer.submit(save_image, generated.data, generated.mime_type, base_name, save_mode,
+                                             filesystem_path=FILESYSTEM_SAVE_PATH)
+    if save_mode == "s3" and minio_client:
+        return base_name, save_writer.submit(save_image, generated.data, generated.mime_type, base_name, save_mode,
+                                             client=minio_client, bucket_name=S3_BUCKET_NAME, spool=s3_spool)
+    return base_name, None
+
+
+def generate_and_save(model, contents, cache_key, progress, saves):
+    """Generation job that also starts saving its images, so a closed tab doesn't lose a paid result.
+
+    Runs on a generation worker; saves maps image index -> (base_name, future or None).
+    """
+    result = gemini.generate(model, contents, cache_key, progress)
+    for index, generated in enumerate(result.images):
+        # Streamed images already started saving as they arrived
+        if index not in saves:
+            saves[index] = start_save(generated, index)
+    return result
+
+
 # --- Generate button ---
-generate_btn = st.button("🚀 Generate AI Image", use_container_width=True)
+# Collect finished jobs first: a job that completes on this run is cleared further down,
+# and the button would otherwise stay disabled until some other widget triggers a rerun
+job = st.session_state.generation_job
+if job:
+    collect_results(job)
+generation_pending = job is not None and job["picked"] is None and (len(job["ids"]) > 1 or not job["results"])
+generate_btn = st.button("🚀 Generate AI Image", use_container_width=True, disabled=generation_pending)
 
 if generate_btn:
     if not prompt.strip():
@@ -165,132 +312,358 @@ if generate_btn:
     elif 'img1' not in st.session_state.uploaded_images:
         st.warning("⚠️ Please upload at least the first image")
     else:
-        with st.spinner("✨ Creating your masterpiece..."):
+        final_prompt = gemini.build_prompt(prompt, model_choice, image_ratio)
+        contents = [final_prompt]
+        processed = []
+        for i in range(1,5):
+            key = f'img{i}'
+            if key in st.session_state.uploaded_images:
+                contents.append(gemini.prepare_input(
+                    st.session_state.uploaded_images[key],
+                    st.session_state.uploaded_digests[key],
+                    api_model_name,
+                    *st.session_state.uploaded_sources[key]
+                ))
+                processed.append(key)
+
+        input_digests = [st.session_state.uploaded_digests[key] for key in processed]
+        cache_key = request_digest(api_model_name, final_prompt, input_digests)
+
+        user_turn = None
+        if edit_mode:
+            edit_session = st.session_state.get("edit_session")
+            # A different model or different inputs start a fresh edit session
+            if edit_session is None or not edit_session.matches(api_model_name, input_digests):
+                edit_session = gemini.EditSession(api_model_name, input_digests, gemini.GEMINI_EDIT_MAX_TURNS)
+                st.session_state.edit_session = edit_session
+            if edit_session.turns:
+                # Follow-up: the inputs and the last result are already in the history
+                user_turn = {"role": "user", "parts": [final_prompt]}
+                contents = edit_session.contents(user_turn)
+                cache_key = None
+            else:
+                user_turn = {"role": "user", "parts": contents}
+
+        saves = {}
+        # Streaming shows one response as it arrives; candidates are compared once finished
+        progress = None
+        if stream_results and num_candidates == 1:
+            # Each streamed image starts saving on the worker as soon as it arrives
+            progress = gemini.GenerationProgress(
+                on_image=lambda index, generated: saves.__setitem__(index, start_save(generated, index))
+            )
+        job_ids = []
+        if num_candidates > 1:
+            # Identical keys would be coalesced or served from cache; candidates need separate calls.
+            # Only the picked candidate is saved, once it is picked.
+            for _ in range(num_candidates):
+                try:
+                    job_ids.append(generation_jobs.submit(gemini.generate, model, contents))
+                except QueueFull:
+                    break
+        else:
             try:
-                # Incorporate model-specific settings into the prompt
-                final_prompt = prompt.strip()
-                if model_choice == "gemini-3.0-nano-banana-pro":
-                    final_prompt += f"\n\nSpecifications:\n- Aspect Ratio: {image_ratio}"
-                
-                contents = [final_prompt]
-                processed = []
-                for i in range(1,5):
-                    key = f'img{i}'
-                    if key in st.session_state.uploaded_images:
-                        contents.append(st.session_state.uploaded_images[key])
-                        processed.append(key)
-                
-                response = model.generate_content(
-                    contents, 
-                    stream=False
-                )
-
-                found_image = False
-                text_output = None
-
-                for part in response.parts:
-                    if hasattr(part, "text") and part.text:
-                        text_output = part.text
-                    elif hasattr(part, "inline_data") and part.inline_data:
-                        img = Image.open(BytesIO(part.inline_data.data)).convert("RGB")
-                        st.session_state.generated_image = img
-
-                        # Always save as PNG
-                        img_bytes = BytesIO()
-                        img.save(img_bytes, format="PNG")
-                        img_bytes.seek(0)
-                        st.session_state.generated_image_bytes = img_bytes.getvalue()
-
-                        # Build filename
-                        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                        base_name = f"gemini_image_{timestamp}.png"
-
-                        # Apply date folder if requested
-                        if save_with_date_folder:
-                            date_str = datetime.now().strftime("%Y-%m-%d")
-                            base_name = os.path.join(date_str, base_name)
-
-                        st.session_state.current_filename = base_name
-
-                        # Save according to mode
-                        if save_mode == "filesystem":
-                            full_path = os.path.join(FILESYSTEM_SAVE_PATH, base_name)
-                            # Ensure directory exists
-                            dir_path = os.path.dirname(full_path)
-                            os.makedirs(dir_path, exist_ok=True)
-                            with open(full_path, "wb") as f:
-                                f.write(st.session_state.generated_image_bytes)
-                            st.success(f"✅ Saved to filesystem: {full_path}")
-
-                        elif save_mode == "s3" and minio_client:
-                            try:
-                                minio_client.put_object(
-                                    S3_BUCKET_NAME,
-                                    base_name.replace("\\", "/"),
-                                    BytesIO(st.session_state.generated_image_bytes),
-                                    length=len(st.session_state.generated_image_bytes),
-                                    content_type="image/png"
-                                )
-                                st.success(f"✅ Saved to S3: {base_name}")
-                            except Exception as e:
-                                st.error(f"❌ S3 upload failed: {e}")
-
-                        else:
-                            # Memory-only
-                            st.info("ℹ️ Image is available for download only (not stored permanently)")
-
-                        found_image = True
-
-                if not found_image:
-                    st.error("❌ No image was generated. Please try a different prompt.")
-                else:
-                    st.success(f"🎉 Successfully generated image using {len(processed)} input image(s)!")
-
-                if text_output:
-                    with st.expander("📝 View AI Response Text"):
-                        st.write(text_output)
-
-            except Exception as e:
-                st.error(f"🚨 An error occurred: {e}")
+                job_ids.append(generation_jobs.submit(generate_and_save, model, contents, cache_key, progress, saves))
+            except QueueFull:
+                pass
+        if job_ids:
+            st.session_state.generation_job = {
+                "ids": job_ids,
+                "results": {},
+                "picked": None,
+                "missed": 0,
+                "deadline": time.time() + CANDIDATE_DEADLINE if num_candidates > 1 else None,
+                "num_inputs": len(processed),
+                "progress": progress,
+                "saves": saves,
+                "user_turn": user_turn
+            }
+            if len(job_ids) < num_candidates:
+                st.warning(f"⏳ The generation queue is busy; running {len(job_ids)} of {num_candidates} candidates.")
+        else:
+            st.warning("⏳ Too many generations in progress right now. Please try again in a moment.")
+
+
+def abandon_pending(job):
+    # Queued candidates are cancelled; ones already running finish unobserved.
+    # Their outcome is recorded so later reruns don't report them as lost jobs.
+    for index, job_id in enumerate(job["ids"]):
+        if index not in job["results"]:
+            future = generation_jobs.get(job_id)
+            if future is not None:
+                future.cancel()
+            generation_jobs.discard(job_id)
+            job["results"][index] = TimeoutError(f"Missed the {CANDIDATE_DEADLINE:.0f}s deadline.")
+            job["missed"] += 1
+
+
+def render_candidates(job):
+    st.caption("Pick the candidate to keep; only the picked image is saved.")
+    cols_cand = st.columns(min(4, len(job["ids"])))
+    for index in range(len(job["ids"])):
+        with cols_cand[index % len(cols_cand)]:
+            st.markdown(f"**🎲 Candidate {index + 1}**")
+            outcome = job["results"].get(index)
+            if outcome is None:
+                st.info("⏳ Generating...")
+            elif isinstance(outcome, Exception):
+                st.error(f"🚨 {outcome}")
+            elif not outcome.images:
+                st.warning("❌ No image")
+            else:
+                generated = outcome.images[0]
+                digest = image_digest(generated.data)
+                st.image(thumbnail_from_bytes(generated.data, digest, thumb_size))
+                if st.button("🏆 Pick", key=f"pick_candidate_{index}"):
+                    job["picked"] = index
+                    st.rerun()
+
+
+@st.fragment(run_every=JOB_POLL_INTERVAL)
+def wait_for_generation(job):
+    collect_results(job)
+    pending = len(job["ids"]) - len(job["results"])
+    if not pending or (job["deadline"] and time.time() > job["deadline"]):
+        st.rerun()
+
+    if len(job["ids"]) > 1:
+        st.info(f"✨ {len(job['results'])} of {len(job['ids'])} candidates ready...")
+        render_candidates(job)
+        return
+
+    ahead = generation_jobs.position(job["ids"][0])
+    if ahead:
+        st.info(f"⏳ Queued behind {ahead} other generation(s)...")
+    else:
+        st.info("✨ Creating your masterpiece...")
+
+    if job["progress"] is not None:
+        text, images = job["progress"].snapshot()
+        for generated in images:
+            digest = image_digest(generated.data)
+            st.image(thumbnail_from_bytes(generated.data, digest, thumb_size))
+        if text:
+            st.markdown(text)
+
+
+def finish_generation(job, outcome):
+    if isinstance(outcome, Exception):
+        st.error(f"🚨 An error occurred: {outcome}")
+        edit_session = st.session_state.get("edit_session")
+        follow_up = job["user_turn"] is not None and edit_session is not None and edit_session.turns
+        if follow_up and gemini.is_history_rejected(outcome):
+            # A rejected follow-up would fail the same way every time; start the next edit from the inputs
+            edit_session.reset()
+            st.warning("↩️ The model rejected the edit history, so the edit session was reset.")
+        return
+    result = outcome
+
+    generated_images = []
+    saves = []
+    for index, generated in enumerate(result.images):
+        # Single generations were saved by their job; a picked candidate starts saving now
+        base_name, save = job["saves"].get(index) or start_save(generated, index)
+        saves.append((base_name, save))
+        # Only the model's encoded bytes and a thumbnail are kept; full-size decodes happen on demand
+        digest = image_digest(generated.data)
+        generated_images.append({
+            "thumbnail": thumbnail_from_bytes(generated.data, digest, thumb_size),
+            "thumb_size": thumb_size,
+            "data": generated.data,
+            "mime_type": generated.mime_type,
+            "digest": digest,
+            "filename": base_name,
+            "save": save
+        })
+    if generated_images:
+        st.session_state.generated_images = generated_images
+
+    # Writes finish in the background; their status is reported once they complete
+    if saves and save_mode in ("filesystem", "s3") and (save_mode == "filesystem" or minio_client):
+        st.session_state.pending_saves = {
+            "target": "filesystem" if save_mode == "filesystem" else "S3",
+            "saves": saves
+        }
+    elif saves:
+        # Memory-only
+        st.info("ℹ️ Images are available for download only (not stored permanently)")
+
+    edit_session = st.session_state.get("edit_session")
+    if job["user_turn"] is not None and edit_session is not None and result.images:
+        edit_session.record(job["user_turn"], result)
+
+    if not result.images:
+        st.error("❌ No image was generated. Please try a different prompt.")
+    else:
+        st.success(
+            f"🎉 Successfully generated {len(result.images)} image(s) using {job['num_inputs']} input image(s)!"
+        )
+        if result.cached:
+            st.caption("♻️ Reused the result of an identical request (no extra API call)")
+
+    if result.text:
+        with st.expander("📝 View AI Response Text"):
+            st.write(result.text)
+
+
+def report_saves(pending):
+    """One aggregated status message for a finished batch of background saves."""
+    saved = []
+    failed = []
+    for base_name, save in pending["saves"]:
+        try:
+            saved.append(save.result())
+        except Exception as e:
+            failed.append(f"{base_name} ({e})")
+    if saved and pending["target"] == "S3" and s3_spool is not None:
+        # Spooled writes are on local disk; the upload itself happens in the background
+        st.success(f"✅ Stored {len(saved)} image(s) for upload to S3: {', '.join(saved)}")
+    elif saved:
+        st.success(f"✅ Saved {len(saved)} image(s) to {pending['target']}: {', '.join(saved)}")
+    if failed:
+        st.error(f"❌ {len(failed)} {pending['target']} save(s) failed: {'; '.join(failed)}")
+    if pending["target"] == "S3" and s3_spool is not None and s3_spool.pending():
+        st.info(f"📦 {s3_spool.pending()} upload(s) are waiting in the local spool and will be retried")
+
+
+@st.fragment(run_every=JOB_POLL_INTERVAL)
+def wait_for_saves(pending):
+    if all(save.done() for _, save in pending["saves"]):
+        st.rerun()
+    st.info(f"💾 Saving {len(pending['saves'])} image(s) to {pending['target']}...")
+
+
+def stored_url(generated, download=False):
+    """Presigned URL for a generated image once its S3 upload has landed; None means serve the bytes."""
+    save = generated["save"]
+    if presign_client is None or save_mode != "s3" or save is None or not save.done() or save.exception():
+        return None
+    object_name = save.result()
+    if s3_spool is not None and s3_spool.holds(object_name):
+        return None
+    try:
+        return presigned_url(presign_client, S3_BUCKET_NAME, object_name,
+                             os.path.basename(object_name) if download else None)
+    except Exception:
+        return None
+
+
+# --- Generation job status ---
+# Results were collected before the Generate button, so the button state matches what happens here
+job = st.session_state.generation_job
+if job:
+    pending = len(job["ids"]) - len(job["results"])
+    expired = job["deadline"] is not None and time.time() > job["deadline"]
+
+    if job["picked"] is not None or (len(job["ids"]) == 1 and not pending):
+        st.session_state.generation_job = None
+        abandon_pending(job)
+        finish_generation(job, job["results"][job["picked"] or 0])
+    elif pending and not expired:
+        wait_for_generation(job)
+    else:
+        # Every candidate finished, or the shared deadline passed: show what came back
+        abandon_pending(job)
+        if job["missed"]:
+            st.warning(f"⌛ {job['missed']} candidate(s) missed the {CANDIDATE_DEADLINE:.0f}s deadline.")
+        render_candidates(job)
+        if st.button("🗑️ Discard candidates", key="discard_candidates"):
+            st.session_state.generation_job = None
+            st.rerun()
+
+# --- Background save status ---
+pending_saves = st.session_state.pending_saves
+if pending_saves:
+    if all(save.done() for _, save in pending_saves["saves"]):
+        st.session_state.pending_saves = None
+        report_saves(pending_saves)
+    else:
+        wait_for_saves(pending_saves)
 
 # --- Results display ---
-if st.session_state.generated_image:
+if st.session_state.generated_images:
     st.divider()
     st.subheader("🎨 Your Results")
 
+    generated_images = st.session_state.generated_images
     num_inputs = len(st.session_state.uploaded_images)
-    cols_out = st.columns(num_inputs + 1)
+    cols_out = st.columns(num_inputs + len(generated_images))
     col_idx = 0
 
     for key in ['img1','img2','img3','img4']:
         if key in st.session_state.uploaded_images:
             with cols_out[col_idx]:
                 st.markdown(f"**📷 Input {col_idx+1}**")
-                thumb = st.session_state.uploaded_images[key].copy()
-                thumb.thumbnail((thumb_size, thumb_size), Image.Resampling.LANCZOS)
+                thumb = get_thumbnail(
+                    st.session_state.uploaded_images[key],
+                    st.session_state.uploaded_digests[key],
+                    thumb_size
+                )
                 st.image(thumb)
                 if st.button(f"🔍 View full Input {col_idx}", key=f"view_full_input_{key}"):
                     st.image(st.session_state.uploaded_images[key])
                 col_idx += 1
 
-    with cols_out[col_idx]:
-        st.markdown("**✨ Generated**")
-        gen_thumb = st.session_state.generated_image.copy()
-        gen_thumb.thumbnail((thumb_size, thumb_size), Image.Resampling.LANCZOS)
-        st.image(gen_thumb)
-        if st.button("🔍 View full Generated", key="view_full_generated"):
-            st.image(st.session_state.generated_image)
+    for gen_idx, generated in enumerate(generated_images):
+        with cols_out[col_idx]:
+            label = "✨ Generated" + (f" {gen_idx + 1}" if len(generated_images) > 1 else "")
+            st.markdown(f"**{label}**")
+            if generated["thumb_size"] != thumb_size:
+                generated["thumbnail"] = thumbnail_from_bytes(generated["data"], generated["digest"], thumb_size)
+                generated["thumb_size"] = thumb_size
+            st.image(generated["thumbnail"])
+            if st.button(f"🔍 View full {label[2:]}", key=f"view_full_generated_{gen_idx}"):
+                # The browser fetches a stored image from MinIO itself
+                st.image(stored_url(generated) or generated["data"])
+            col_idx += 1
+
+    use_cols = st.columns([2, 1, 1] if len(generated_images) > 1 else [1, 1])
+    if len(generated_images) > 1:
+        with use_cols[-3]:
+            source_idx = st.selectbox(
+                "Generated image", range(len(generated_images)),
+                format_func=lambda idx: f"Generated {idx + 1}",
+                key="use_as_input_source",
+                label_visibility="collapsed"
+            )
+    else:
+        source_idx = 0
+    with use_cols[-2]:
+        target_slot = st.selectbox(
+            "Slot", ["img1", "img2", "img3", "img4"],
+            format_func=lambda key: f"Image {key[-1]}",
+            key="use_as_input_slot",
+            label_visibility="collapsed"
+        )
+    with use_cols[-1]:
+        if st.button("↩️ Use as input", key="use_generated_as_input"):
+            # Hand over the bytes and hash by reference: no download or re-hash, one decode for the input slot
+            source = generated_images[source_idx]
+            st.session_state.uploaded_images[target_slot] = decode_image(source["data"], source["digest"])
+            st.session_state.uploaded_digests[target_slot] = source["digest"]
+            st.session_state.uploaded_sources[target_slot] = (source["data"], source["mime_type"])
+            st.session_state.generated_slots.add(target_slot)
+            st.session_state.uploader_versions[target_slot] += 1
+            st.rerun()
 
     st.markdown("<br>", unsafe_allow_html=True)
-    dl_cols = st.columns([2,2,2])
-    with dl_cols[1]:
-        st.download_button(
-            "⬇️ Download Generated Image",
-            data=st.session_state.generated_image_bytes,
-            file_name=os.path.basename(st.session_state.current_filename),
-            mime="image/png",
-            use_container_width=True
-        )
+    dl_cols = st.columns(len(generated_images) + 2)
+    for gen_idx, generated in enumerate(generated_images):
+        with dl_cols[gen_idx + 1]:
+            download_label = "⬇️ Download Generated Image" + (f" {gen_idx + 1}" if len(generated_images) > 1 else "")
+            download_url = stored_url(generated, download=True)
+            if download_url:
+                # No copy of the bytes goes to Streamlit's media store or over the websocket
+                st.link_button(download_label, download_url, use_container_width=True)
+            else:
+                st.download_button(
+                    download_label,
+                    data=generated["data"],
+                    file_name=os.path.basename(generated["filename"]),
+                    mime=generated["mime_type"],
+                    key=f"download_generated_{gen_idx}",
+                    use_container_width=True
+                )
 
 # --- Updated Inspiration & Example Prompts Section (English README, fixed rendering) ---
 st.divider()
@@ -342,5 +715,15 @@ if save_mode == "filesystem":
     st.sidebar.success("✅ Filesystem saving is active")
 elif save_mode == "s3":
     st.sidebar.success("✅ S3/MinIO saving is active")
+    if s3_spool is not None and s3_spool.pending():
+        st.sidebar.warning(
+            f"📦 {s3_spool.pending()} upload(s) spooled locally ({s3_spool.size() / 1024 / 1024:.1f} MB), retrying"
+        )
+    uploads = upload_stats.summary()
+    if uploads:
+        st.sidebar.caption(
+            f"⬆️ {uploads['uploads']} upload(s), {uploads['bytes'] / 1024 / 1024:.1f} MB, "
+            f"median {uploads['median_mb_per_s']:.1f} MB/s ({uploads['multipart']} multipart)"
+        )
 else:
     st.sidebar.info("ℹ️ No persistent storage configured; images can only be downloaded")
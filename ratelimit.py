@@ -0,0 +1,128 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from google.api_core import exceptions as api_exceptions
+
+# --- Per-model quota limits ---
+# Requests per minute, e.g. "gemini-3-pro-image-preview=10,gemini-2.5-flash-image-preview=60"
+GEMINI_RATE_LIMITS = os.getenv("GEMINI_RATE_LIMITS", "")
+# Used for models not listed above; 0 disables the token bucket
+GEMINI_DEFAULT_RPM = float(os.getenv("GEMINI_DEFAULT_RPM", "0"))
+# Upper bound for the adaptive per-model concurrency limit
+GEMINI_MODEL_CONCURRENCY = int(os.getenv("GEMINI_MODEL_CONCURRENCY", os.getenv("GEMINI_MAX_INFLIGHT", "8")))
+
+
+def is_quota_error(error):
+    if isinstance(error, (api_exceptions.ResourceExhausted, api_exceptions.TooManyRequests)):
+        return True
+    return getattr(error, "code", None) == 429
+
+
+class TokenBucket:
+    """Classic token bucket; acquire() waits for a token instead of failing."""
+
+    def __init__(self, rate_per_minute, burst=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = burst or max(1.0, rate_per_minute / 60.0)
+        self.tokens = self.capacity
+        self._updated = time.monotonic()
+        self._cond = threading.Condition()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        with self._cond:
+            while True:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                self._cond.wait((1 - self.tokens) / self.rate)
+
+    def drain(self):
+        """Empty the bucket after a quota error so waiters back off for a full refill interval."""
+        with self._cond:
+            self._refill()
+            self.tokens = min(self.tokens, 0)
+
+
+class AdaptiveConcurrency:
+    """AIMD concurrency limit: +1 per window of successes, halved on each quota error."""
+
+    def __init__(self, max_limit, min_limit=1):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = float(max_limit)
+        self.inflight = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self.inflight >= int(self.limit):
+                self._cond.wait()
+            self.inflight += 1
+
+    def release(self, throttled=False):
+        with self._cond:
+            self.inflight -= 1
+            if throttled:
+                self.limit = max(self.min_limit, self.limit / 2)
+            else:
+                # Additive increase: one extra slot after roughly `limit` successes
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+
+class ModelLimiter:
+    def __init__(self, rate_per_minute, max_concurrency):
+        self.bucket = TokenBucket(rate_per_minute) if rate_per_minute > 0 else None
+        self.concurrency = AdaptiveConcurrency(max_concurrency)
+
+    @contextmanager
+    def slot(self):
+        """Wait for a concurrency slot and a rate token; adapt the limits to how the call ends."""
+        self.concurrency.acquire()
+        throttled = False
+        try:
+            if self.bucket:
+                self.bucket.acquire()
+            yield
+        except Exception as e:
+            throttled = is_quota_error(e)
+            if throttled and self.bucket:
+                self.bucket.drain()
+            raise
+        finally:
+            self.concurrency.release(throttled)
+
+
+def parse_model_limits(spec):
+    """Parse "model=value,model=value" settings into a dict of floats."""
+    limits = {}
+    for item in spec.split(","):
+        if "=" in item:
+            name, value = item.split("=", 1)
+            limits[name.strip()] = float(value)
+    return limits
+
+
+_rate_limits = parse_model_limits(GEMINI_RATE_LIMITS)
+_limiters = {}
+_lock = threading.Lock()
+
+
+def limiter_for(model_name):
+    """Process-wide limiter for an API model name (a "models/" prefix is ignored)."""
+    model_name = model_name.removeprefix("models/")
+    with _lock:
+        limiter = _limiters.get(model_name)
+        if limiter is None:
+            rate = _rate_limits.get(model_name, GEMINI_DEFAULT_RPM)
+            limiter = ModelLimiter(rate, GEMINI_MODEL_CONCURRENCY)
+            _limiters[model_name] = limiter
+        return limiter
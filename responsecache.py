@@ -0,0 +1,121 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+
+from storage import extension_for
+
+# --- Response cache (opt-in: set RESPONSE_CACHE_DIR) ---
+RESPONSE_CACHE_DIR = os.getenv("RESPONSE_CACHE_DIR")
+RESPONSE_CACHE_MAX_MB = int(os.getenv("RESPONSE_CACHE_MAX_MB", "1024"))
+# Entries older than this many seconds are treated as misses; 0 disables expiry
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", str(7 * 24 * 3600)))
+# Image files are written before their metadata; orphans younger than this may belong to a put in progress
+ORPHAN_GRACE_SECONDS = 300
+
+
+def request_digest(model_name, prompt, image_digests):
+    """Cache key for a generation: API model name, final prompt and input image hashes, in order."""
+    payload = json.dumps([model_name, prompt, list(image_digests)], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """On-disk cache of generation outputs with a size cap, LRU eviction and a TTL.
+
+    Each entry is a metadata file plus one file per output image. The metadata
+    is written last (atomically), so an entry exists only once it is complete,
+    and its mtime is bumped on every hit to drive LRU eviction.
+    """
+
+    def __init__(self, directory, max_bytes, ttl):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _meta_path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key):
+        """Return (images, text) for a cached request, images as (data, mime_type) pairs, or None."""
+        meta_path = self._meta_path(key)
+        try:
+            with open(meta_path, encoding="utf-8") as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            self._remove(f"{key}.json")
+            return None
+        try:
+            if self.ttl and time.time() - meta["created"] > self.ttl:
+                self._remove(f"{key}.json")
+                return None
+            images = []
+            for entry in meta["images"]:
+                with open(os.path.join(self.directory, entry["file"]), "rb") as f:
+                    images.append((f.read(), entry["mime_type"]))
+            os.utime(meta_path)
+        except (OSError, ValueError, KeyError):
+            # Corrupt or half-evicted entry (including a missing image file): drop it and treat as a miss
+            self._remove(f"{key}.json")
+            return None
+        return images, meta.get("text")
+
+    def put(self, key, images, text):
+        meta = {"created": time.time(), "text": text, "images": []}
+        for index, (data, mime_type) in enumerate(images):
+            file_name = f"{key}_{index}{extension_for(mime_type)}"
+            self._write_atomic(file_name, data)
+            meta["images"].append({"file": file_name, "mime_type": mime_type})
+        self._write_atomic(f"{key}.json", json.dumps(meta).encode("utf-8"))
+        self._evict()
+
+    def _write_atomic(self, file_name, data):
+        tmp_path = os.path.join(self.directory, f".{file_name}.{uuid.uuid4().hex}.tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, os.path.join(self.directory, file_name))
+
+    def _remove(self, *file_names):
+        for file_name in file_names:
+            try:
+                os.remove(os.path.join(self.directory, file_name))
+            except FileNotFoundError:
+                pass
+
+    def _evict(self):
+        with self._lock:
+            entries = {}
+            total = 0
+            for entry in os.scandir(self.directory):
+                if entry.name.startswith("."):
+                    continue
+                key = entry.name.split(".", 1)[0].split("_", 1)[0]
+                stat = entry.stat()
+                total += stat.st_size
+                record = entries.setdefault(key, {"size": 0, "used": 0, "newest": 0, "files": []})
+                record["size"] += stat.st_size
+                record["newest"] = max(record["newest"], stat.st_mtime)
+                record["files"].append(entry.name)
+                if entry.name.endswith(".json"):
+                    record["used"] = stat.st_mtime
+            orphan_cutoff = time.time() - ORPHAN_GRACE_SECONDS
+            for record in sorted(entries.values(), key=lambda record: record["used"]):
+                if total <= self.max_bytes:
+                    break
+                # Image files left without metadata keep used=0 and go first,
+                # unless they are recent enough to belong to a put that hasn't written its metadata yet
+                if not record["used"] and record["newest"] > orphan_cutoff:
+                    continue
+                self._remove(*record["files"])
+                total -= record["size"]
+
+
+response_cache = None
+if RESPONSE_CACHE_DIR:
+    response_cache = ResponseCache(RESPONSE_CACHE_DIR, RESPONSE_CACHE_MAX_MB * 1024 * 1024, RESPONSE_CACHE_TTL)
@@ -0,0 +1,119 @@
+import logging
+import os
+import random
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from google.api_core import exceptions as api_exceptions
+
+logger = logging.getLogger(__name__)
+
+# --- Retry policy ---
+GEMINI_MAX_ATTEMPTS = int(os.getenv("GEMINI_MAX_ATTEMPTS", "4"))
+GEMINI_BACKOFF_BASE = float(os.getenv("GEMINI_BACKOFF_BASE", "1.0"))
+GEMINI_BACKOFF_MAX = float(os.getenv("GEMINI_BACKOFF_MAX", "30"))
+
+# --- Hedging (opt-in) ---
+# Send a second request once the first has run longer than this latency percentile; 0 disables
+GEMINI_HEDGE_PERCENTILE = float(os.getenv("GEMINI_HEDGE_PERCENTILE", "0"))
+GEMINI_HEDGE_MIN_SAMPLES = int(os.getenv("GEMINI_HEDGE_MIN_SAMPLES", "20"))
+GEMINI_HEDGE_WORKERS = int(os.getenv("GEMINI_HEDGE_WORKERS", "16"))
+
+RETRYABLE_ERRORS = (
+    api_exceptions.TooManyRequests,
+    api_exceptions.ResourceExhausted,
+    api_exceptions.InternalServerError,
+    api_exceptions.BadGateway,
+    api_exceptions.ServiceUnavailable,
+    api_exceptions.GatewayTimeout,
+    api_exceptions.DeadlineExceeded,
+    ConnectionError,
+    TimeoutError,
+)
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+def is_retryable(error):
+    """Transient failures (quota, 5xx, deadlines, dropped connections) are retried; anything else is permanent."""
+    if isinstance(error, RETRYABLE_ERRORS):
+        return True
+    return getattr(error, "code", None) in RETRYABLE_STATUS_CODES
+
+
+def backoff_delay(attempt):
+    """Exponential backoff with full jitter for the given zero-based retry attempt."""
+    return random.uniform(0, min(GEMINI_BACKOFF_MAX, GEMINI_BACKOFF_BASE * 2 ** attempt))
+
+
+def call_with_retry(fn, max_attempts=None):
+    max_attempts = max_attempts or GEMINI_MAX_ATTEMPTS
+    for attempt in range(max_attempts):
+        try:
+            return fn()
+        except Exception as e:
+            if attempt + 1 >= max_attempts or not is_retryable(e):
+                raise
+            delay = backoff_delay(attempt)
+            logger.warning("Attempt %d/%d failed (%s); retrying in %.1fs", attempt + 1, max_attempts, e, delay)
+            time.sleep(delay)
+
+
+class LatencyTracker:
+    """Rolling window of successful call latencies per key."""
+
+    def __init__(self, window=200):
+        self._samples = defaultdict(lambda: deque(maxlen=window))
+        self._lock = threading.Lock()
+
+    def record(self, key, seconds):
+        with self._lock:
+            self._samples[key].append(seconds)
+
+    def percentile(self, key, pct, min_samples=1):
+        with self._lock:
+            samples = sorted(self._samples[key])
+        if len(samples) < min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+
+latencies = LatencyTracker()
+_hedge_pool = ThreadPoolExecutor(max_workers=GEMINI_HEDGE_WORKERS, thread_name_prefix="hedge")
+
+
+def hedge_delay(key):
+    """Seconds to wait before hedging calls for key, or None when hedging is off or there is no history yet."""
+    if GEMINI_HEDGE_PERCENTILE <= 0:
+        return None
+    return latencies.percentile(key, GEMINI_HEDGE_PERCENTILE, GEMINI_HEDGE_MIN_SAMPLES)
+
+
+def call_hedged(fn, delay):
+    """Run fn(sent); if still running delay seconds after it sent, start a second copy and return the first success.
+
+    fn must call sent.set() once it has its rate-limit slot and is about to
+    send, so time spent queueing for quota doesn't trigger a hedge. The
+    slower copy can't be cancelled once sent and still counts against quota.
+    """
+    if delay is None:
+        return fn(threading.Event())
+    sent = threading.Event()
+    first = _hedge_pool.submit(fn, sent)
+    # A copy that fails or finishes while still queued must not leave us waiting
+    first.add_done_callback(lambda _: sent.set())
+    sent.wait()
+    done, _ = wait([first], timeout=delay)
+    if done:
+        return first.result()
+    logger.info("No response %.1fs after sending; sending a hedged request", delay)
+    pending = {first, _hedge_pool.submit(fn, threading.Event())}
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                return future.result()
+            error = future.exception()
+    raise error
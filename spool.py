@@ -0,0 +1,226 @@
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+
+from storage import ensure_bucket, save_image, sortable_id
+
+logger = logging.getLogger(__name__)
+
+# --- S3 write spool (opt-in: set S3_SPOOL_DIR) ---
+S3_SPOOL_DIR = os.getenv("S3_SPOOL_DIR")
+S3_SPOOL_MAX_MB = int(os.getenv("S3_SPOOL_MAX_MB", "2048"))
+# Replay backoff: full jitter between retries, doubling from the base up to the cap (seconds)
+S3_SPOOL_RETRY_BASE = float(os.getenv("S3_SPOOL_RETRY_BASE", "2"))
+S3_SPOOL_RETRY_MAX = float(os.getenv("S3_SPOOL_RETRY_MAX", "300"))
+# Threads uploading spooled writes
+S3_SPOOL_WORKERS = int(os.getenv("S3_SPOOL_WORKERS", "4"))
+
+
+class SpoolFull(Exception):
+    pass
+
+
+class S3Spool:
+    """Disk-backed queue of S3 writes, uploaded by background drainer threads.
+
+    Writers only persist to local disk, so a slow or unreachable MinIO never
+    holds up a save. Each entry is a data file plus a metadata file naming the
+    bucket, object key and content type. Both are written atomically,
+    metadata last, so an entry exists only once it is complete and survives a
+    crash or restart; entries found on startup are replayed. Entry IDs are
+    ULIDs, so uploads go out oldest first.
+    """
+
+    def __init__(self, directory, max_bytes, client, retry_base, retry_max, workers=1):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.client = client
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        # entry_id -> {"object", "size", "attempts", "next_attempt", "claimed"}
+        self._entries = {}
+        # Buckets known to exist; the app doesn't bootstrap buckets itself in spool mode
+        self._buckets = set()
+        self._cond = threading.Condition()
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+        for index in range(max(1, workers)):
+            threading.Thread(target=self._drain, name=f"s3-spool-{index}", daemon=True).start()
+
+    def _path(self, entry_id, extension):
+        return os.path.join(self.directory, f"{entry_id}{extension}")
+
+    def _load(self):
+        """Pick up entries left by an earlier process and drop partial writes."""
+        names = set(os.listdir(self.directory))
+        for name in names:
+            entry_id, extension = os.path.splitext(name)
+            if name.startswith(".") or (extension == ".bin" and f"{entry_id}.json" not in names):
+                self._remove_file(name)
+            elif extension == ".json":
+                size = os.path.getsize(self._path(entry_id, ".bin")) if f"{entry_id}.bin" in names else 0
+                try:
+                    with open(self._path(entry_id, ".json"), encoding="utf-8") as f:
+                        object_name = json.load(f).get("object")
+                except (OSError, ValueError):
+                    # The drainer drops it when the replay can't read it
+                    object_name = None
+                self._entries[entry_id] = {
+                    "object": object_name, "size": size, "attempts": 0, "next_attempt": 0, "claimed": False
+                }
+        if self._entries:
+            logger.info("Replaying %d spooled S3 write(s) from %s", len(self._entries), self.directory)
+
+    def pending(self):
+        with self._cond:
+            return len(self._entries)
+
+    def size(self):
+        with self._cond:
+            return sum(entry["size"] for entry in self._entries.values())
+
+    def holds(self, object_name):
+        """True while a write to object_name is spooled and not yet uploaded."""
+        with self._cond:
+            return any(entry["object"] == object_name for entry in self._entries.values())
+
+    def _upload(self, data, content_type, object_name, bucket_name):
+        if bucket_name not in self._buckets:
+            ensure_bucket(self.client, bucket_name)
+            self._buckets.add(bucket_name)
+        save_image(data, content_type, object_name, "s3", client=self.client, bucket_name=bucket_name)
+
+    def write(self, data, content_type, object_name, bucket_name):
+        """Persist a write for the drainers to upload; returns once it is safely on local disk.
+
+        Raises SpoolFull when the spool is at its size cap.
+        """
+        entry_id = self._put(data, content_type, object_name, bucket_name)
+        with self._cond:
+            self._entries[entry_id]["claimed"] = False
+            self._cond.notify()
+        return entry_id
+
+    def flush(self, timeout):
+        """Wait up to timeout seconds for the spool to drain; returns how many writes are still pending."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._entries:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return len(self._entries)
+
+    def _put(self, data, content_type, object_name, bucket_name):
+        entry_id = sortable_id()
+        with self._cond:
+            used = sum(entry["size"] for entry in self._entries.values())
+            if used + len(data) > self.max_bytes:
+                raise SpoolFull(f"S3 spool is full ({used / 1024 / 1024:.0f} MB)")
+            # Claimed until both files are written, so the drainers don't pick up a partial entry
+            self._entries[entry_id] = {
+                "object": object_name, "size": len(data), "attempts": 0, "next_attempt": 0, "claimed": True
+            }
+        try:
+            meta = {"bucket": bucket_name, "object": object_name, "content_type": content_type, "created": time.time()}
+            self._write_atomic(f"{entry_id}.bin", data)
+            self._write_atomic(f"{entry_id}.json", json.dumps(meta).encode("utf-8"))
+        except Exception:
+            with self._cond:
+                self._entries.pop(entry_id, None)
+            self._remove_file(f"{entry_id}.bin")
+            raise
+        return entry_id
+
+    def _write_atomic(self, file_name, data):
+        tmp_path = os.path.join(self.directory, f".{file_name}.{uuid.uuid4().hex}.tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, os.path.join(self.directory, file_name))
+
+    def _remove_file(self, file_name):
+        try:
+            os.remove(os.path.join(self.directory, file_name))
+        except FileNotFoundError:
+            pass
+
+    def _done(self, entry_id):
+        # Metadata first: a data file without metadata is discarded on the next startup
+        self._remove_file(f"{entry_id}.json")
+        self._remove_file(f"{entry_id}.bin")
+        with self._cond:
+            self._entries.pop(entry_id, None)
+            self._cond.notify_all()
+
+    def _failed(self, entry_id):
+        with self._cond:
+            entry = self._entries[entry_id]
+            delay = random.uniform(0, min(self.retry_max, self.retry_base * 2 ** entry["attempts"]))
+            entry["attempts"] += 1
+            entry["next_attempt"] = time.monotonic() + delay
+            entry["claimed"] = False
+            self._cond.notify()
+
+    def _claim_due(self):
+        """Wait for and claim the oldest entry whose backoff has expired."""
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                wait = None
+                for entry_id in sorted(self._entries):
+                    entry = self._entries[entry_id]
+                    if entry["claimed"]:
+                        continue
+                    if entry["next_attempt"] <= now:
+                        entry["claimed"] = True
+                        return entry_id
+                    remaining = entry["next_attempt"] - now
+                    wait = remaining if wait is None else min(wait, remaining)
+                self._cond.wait(wait)
+
+    def _drain(self):
+        while True:
+            entry_id = self._claim_due()
+            try:
+                with open(self._path(entry_id, ".json"), encoding="utf-8") as f:
+                    meta = json.load(f)
+                with open(self._path(entry_id, ".bin"), "rb") as f:
+                    data = f.read()
+            except (OSError, ValueError) as e:
+                logger.error("Dropping unreadable spool entry %s: %s", entry_id, e)
+                self._done(entry_id)
+                continue
+            try:
+                self._upload(data, meta["content_type"], meta["object"], meta["bucket"])
+            except Exception as e:
+                logger.warning("Upload of spooled %s failed (%s); retrying with backoff", meta["object"], e)
+                self._failed(entry_id)
+            else:
+                self._done(entry_id)
+
+
+_spool = None
+_spool_lock = threading.Lock()
+
+
+def get_spool(client):
+    """Process-wide spool using the process's shared S3 client, or None when S3_SPOOL_DIR is unset.
+
+    Created on first use, so entries left by an earlier run are replayed as
+    soon as S3 is configured.
+    """
+    global _spool
+    if not S3_SPOOL_DIR:
+        return None
+    with _spool_lock:
+        if _spool is None:
+            _spool = S3Spool(S3_SPOOL_DIR, S3_SPOOL_MAX_MB * 1024 * 1024, client,
+                             S3_SPOOL_RETRY_BASE, S3_SPOOL_RETRY_MAX, S3_SPOOL_WORKERS)
+        return _spool
@@ -0,0 +1,326 @@
+import atexit
+import logging
+import mimetypes
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import Future
+from datetime import datetime, timedelta
+from io import BytesIO
+
+import certifi
+import urllib3
+from minio import Minio
+from minio.error import S3Error
+
+logger = logging.getLogger(__name__)
+
+# --- Connection pool tuning ---
+S3_POOL_MAXSIZE = int(os.getenv("S3_POOL_MAXSIZE", "32"))
+S3_CONNECT_TIMEOUT = float(os.getenv("S3_CONNECT_TIMEOUT", "5"))
+S3_READ_TIMEOUT = float(os.getenv("S3_READ_TIMEOUT", "60"))
+
+# --- S3 uploads ---
+# Objects at least this large are sent as multipart uploads with parts uploaded concurrently
+S3_MULTIPART_THRESHOLD_MB = float(os.getenv("S3_MULTIPART_THRESHOLD_MB", "16"))
+# S3 requires parts of at least 5 MiB
+S3_PART_SIZE_MB = max(5, int(os.getenv("S3_PART_SIZE_MB", "8")))
+S3_PARALLEL_PARTS = int(os.getenv("S3_PARALLEL_PARTS", "4"))
+
+# --- Presigned downloads ---
+# In S3 mode, downloads and full-size views use presigned GET URLs instead of streaming bytes through the app
+S3_PRESIGNED_URLS = os.getenv("S3_PRESIGNED_URLS", "true").lower() == "true"
+S3_PRESIGN_EXPIRY = int(os.getenv("S3_PRESIGN_EXPIRY", "900"))
+# Host browsers use to reach MinIO, when it differs from S3_ENDPOINT (e.g. an in-cluster service name)
+S3_PUBLIC_ENDPOINT = os.getenv("S3_PUBLIC_ENDPOINT")
+# Scheme of presigned URLs; unset means the same as S3_SECURE (e.g. HTTPS ingress in front of plain-HTTP MinIO)
+S3_PUBLIC_SECURE = os.getenv("S3_PUBLIC_SECURE")
+S3_REGION = os.getenv("S3_REGION", "us-east-1")
+
+# --- Write-behind saves ---
+SAVE_WORKERS = int(os.getenv("SAVE_WORKERS", "4"))
+# Writes waiting for a worker; submitting more blocks until one is taken
+SAVE_QUEUE_LIMIT = int(os.getenv("SAVE_QUEUE_LIMIT", "64"))
+# On shutdown, wait this many seconds for queued writes before giving up
+SAVE_FLUSH_TIMEOUT = float(os.getenv("SAVE_FLUSH_TIMEOUT", "30"))
+
+# --- Output naming ---
+# Store outputs under their content hash and skip writes whose bytes are already stored
+SAVE_CONTENT_ADDRESSED = os.getenv("SAVE_CONTENT_ADDRESSED", "false").lower() == "true"
+CONTENT_ADDRESSED_PREFIX = "by-hash"
+
+IMAGE_EXTENSIONS = {
+    "image/png": ".png",
+    "image/jpeg": ".jpg",
+    "image/webp": ".webp",
+    "image/gif": ".gif",
+}
+
+
+def make_http_client():
+    """Pooled urllib3 client shared by every request a Minio client makes."""
+    return urllib3.PoolManager(
+        num_pools=4,
+        maxsize=S3_POOL_MAXSIZE,
+        block=False,
+        timeout=urllib3.Timeout(connect=S3_CONNECT_TIMEOUT, read=S3_READ_TIMEOUT),
+        cert_reqs="CERT_REQUIRED",
+        ca_certs=os.environ.get("SSL_CERT_FILE") or certifi.where(),
+        retries=urllib3.Retry(
+            total=3,
+            backoff_factor=0.2,
+            status_forcelist=[500, 502, 503, 504]
+        )
+    )
+
+
+def make_minio_client(endpoint, access_key, secret_key, secure, region=None):
+    return Minio(
+        endpoint,
+        access_key=access_key,
+        secret_key=secret_key,
+        secure=secure,
+        region=region,
+        http_client=make_http_client()
+    )
+
+
+def make_presign_client(endpoint, access_key, secret_key, secure):
+    """Client used only to sign URLs, for S3_PUBLIC_ENDPOINT when set.
+
+    The region is fixed so signing never has to reach the (possibly
+    unreachable from here) public endpoint to look it up.
+    """
+    if S3_PUBLIC_SECURE is not None:
+        secure = S3_PUBLIC_SECURE.lower() == "true"
+    return make_minio_client(S3_PUBLIC_ENDPOINT or endpoint, access_key, secret_key, secure, region=S3_REGION)
+
+
+def presigned_url(client, bucket_name, object_name, download_name=None):
+    """Short-lived GET URL for an object; with download_name the browser saves it under that name."""
+    response_headers = None
+    if download_name:
+        response_headers = {"response-content-disposition": f'attachment; filename="{download_name}"'}
+    return client.presigned_get_object(
+        bucket_name, object_name,
+        expires=timedelta(seconds=S3_PRESIGN_EXPIRY),
+        response_headers=response_headers
+    )
+
+
+def ensure_bucket(client, bucket_name):
+    if not client.bucket_exists(bucket_name):
+        client.make_bucket(bucket_name)
+
+
+def extension_for(mime_type):
+    return IMAGE_EXTENSIONS.get(mime_type) or mimetypes.guess_extension(mime_type or "") or ".png"
+
+
+_CROCKFORD_BASE32 = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+
+
+def sortable_id():
+    """26-character ULID: 48-bit millisecond timestamp then 80 random bits.
+
+    IDs sort by creation time and don't collide across sessions or replicas
+    sharing one output directory or bucket.
+    """
+    value = (time.time_ns() // 1_000_000) << 80 | int.from_bytes(os.urandom(10), "big")
+    chars = []
+    for _ in range(26):
+        chars.append(_CROCKFORD_BASE32[value & 31])
+        value >>= 5
+    return "".join(reversed(chars))
+
+
+def build_filename(mime_type, date_folder=False, suffix=None, digest=None):
+    """Relative output name for a generated image.
+
+    With SAVE_CONTENT_ADDRESSED and a digest, the name is derived from the
+    content hash alone (date folder and suffix don't apply), so identical
+    outputs map to one file.
+    """
+    if SAVE_CONTENT_ADDRESSED and digest:
+        return f"{CONTENT_ADDRESSED_PREFIX}/{digest[:2]}/{digest}{extension_for(mime_type)}"
+    base_name = f"gemini_image_{sortable_id()}"
+    if suffix:
+        base_name += f"_{suffix}"
+    base_name += extension_for(mime_type)
+    if date_folder:
+        base_name = os.path.join(datetime.now().strftime("%Y-%m-%d"), base_name)
+    return base_name
+
+
+def is_content_addressed(base_name):
+    return base_name.startswith(CONTENT_ADDRESSED_PREFIX + "/")
+
+
+class UploadStats:
+    """Rolling window of S3 upload sizes, durations and part counts."""
+
+    def __init__(self, window=200):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, size, seconds, parts):
+        with self._lock:
+            self._samples.append((size, seconds, parts))
+
+    def summary(self):
+        """Upload count, total bytes and median throughput in MB/s over the window, or None before any upload."""
+        with self._lock:
+            samples = list(self._samples)
+        if not samples:
+            return None
+        rates = sorted(size / max(seconds, 1e-6) / 1024 / 1024 for size, seconds, _ in samples)
+        return {
+            "uploads": len(samples),
+            "bytes": sum(size for size, _, _ in samples),
+            "multipart": sum(1 for _, _, parts in samples if parts > 1),
+            "median_mb_per_s": rates[len(rates) // 2],
+        }
+
+
+upload_stats = UploadStats()
+
+
+def upload_object(client, bucket_name, object_name, data, content_type):
+    """put_object tuned by size: one PUT below S3_MULTIPART_THRESHOLD_MB, concurrent multipart parts above it."""
+    size = len(data)
+    if size >= S3_MULTIPART_THRESHOLD_MB * 1024 * 1024:
+        part_size = S3_PART_SIZE_MB * 1024 * 1024
+        parallel = S3_PARALLEL_PARTS
+    else:
+        # minio switches to multipart whenever length exceeds part_size
+        part_size = max(5 * 1024 * 1024, size)
+        parallel = 1
+    parts = -(-size // part_size) or 1
+    started = time.monotonic()
+    client.put_object(bucket_name, object_name, BytesIO(data), length=size, content_type=content_type,
+                      part_size=part_size, num_parallel_uploads=parallel)
+    seconds = time.monotonic() - started
+    upload_stats.record(size, seconds, parts)
+    logger.info("Uploaded %s: %.1f MB in %d part(s), %.2fs, %.1f MB/s",
+                object_name, size / 1024 / 1024, parts, seconds, size / max(seconds, 1e-6) / 1024 / 1024)
+    return object_name
+
+
+def object_exists(client, bucket_name, object_name):
+    try:
+        client.stat_object(bucket_name, object_name)
+    except S3Error as e:
+        if e.code in ("NoSuchKey", "NoSuchObject", "ResourceNotFound"):
+            return False
+        raise
+    return True
+
+
+def save_image(data, mime_type, base_name, save_mode, filesystem_path=None, client=None, bucket_name=None,
+               spool=None):
+    """Persist image bytes per save mode; returns the path or object key written, None in memory mode.
+
+    Content-addressed names that already exist are not written again. With a
+    spool, S3 writes are persisted to local disk and uploaded in the background,
+    so a slow or unreachable S3 never holds up the save.
+    """
+    if save_mode == "filesystem":
+        full_path = os.path.join(filesystem_path, base_name)
+        if is_content_addressed(base_name) and os.path.exists(full_path):
+            return full_path
+        # Ensure directory exists
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        # Write to a temporary name and rename, so a file that exists is always complete
+        tmp_path = os.path.join(os.path.dirname(full_path), f".{os.path.basename(full_path)}.{uuid.uuid4().hex}.tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, full_path)
+        return full_path
+    if save_mode == "s3":
+        object_name = base_name.replace("\\", "/")
+        if spool is not None:
+            try:
+                spool.write(data, mime_type, object_name, bucket_name)
+                return object_name
+            except Exception as e:
+                # Spool full or its disk unwritable: fall back to a direct upload
+                logger.warning("Not spooling %s (%s); uploading directly", object_name, e)
+        if is_content_addressed(object_name) and object_exists(client, bucket_name, object_name):
+            return object_name
+        return upload_object(client, bucket_name, object_name, data, mime_type)
+    return None
+
+
+class WriteBehind:
+    """Background writer: a bounded queue drained by daemon worker threads.
+
+    submit() returns a Future for the write and blocks only while the queue is
+    full. flush() waits for outstanding writes with a deadline, so shutdown
+    can't hang on an unreachable bucket or a stuck mount.
+    """
+
+    def __init__(self, workers, queue_limit):
+        self._queue = queue.Queue(maxsize=queue_limit)
+        self._pending = 0
+        self._cond = threading.Condition()
+        for index in range(workers):
+            threading.Thread(target=self._work, name=f"save-{index}", daemon=True).start()
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        with self._cond:
+            self._pending += 1
+        self._queue.put((future, fn, args, kwargs))
+        return future
+
+    def _work(self):
+        while True:
+            future, fn, args, kwargs = self._queue.get()
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(fn(*args, **kwargs))
+                    except BaseException as e:
+                        future.set_exception(e)
+            finally:
+                with self._cond:
+                    self._pending -= 1
+                    self._cond.notify_all()
+
+    def pending(self):
+        """Writes queued or in progress."""
+        with self._cond:
+            return self._pending
+
+    def flush(self, timeout):
+        """Wait up to timeout seconds for outstanding writes; returns how many are still pending."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return self._pending
+
+
+save_writer = WriteBehind(SAVE_WORKERS, SAVE_QUEUE_LIMIT)
+
+
+@atexit.register
+def _flush_saves():
+    unsaved = save_writer.flush(SAVE_FLUSH_TIMEOUT)
+    if unsaved:
+        logger.warning("Exiting with %d image(s) not saved after waiting %.0fs", unsaved, SAVE_FLUSH_TIMEOUT)
+
+
+def read_object(client, bucket_name, object_name):
+    response = client.get_object(bucket_name, object_name)
+    try:
+        return response.read()
+    finally:
+        response.close()
+        response.release_conn()